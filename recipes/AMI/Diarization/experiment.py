@@ -7,8 +7,9 @@ To run this recipe:
 
 Condition: Oracle VAD (speech regions taken from the groundtruth).
 
-Note: There are multiple ways to write this recipe. We iterate over individual recordings.
- This approach is less GPU memory demanding and also makes code easy to understand.
+Note: There are multiple ways to write this recipe. Embeddings are extracted in large
+ batches spanning all the recordings of a split (see `embedding_batch_size`), while the
+ recordings are clustered independently, in parallel processes (see `n_jobs`).
 
 Citation: This recipe is based on the following paper,
  N. Dawalatabad, M. Ravanelli, F. Grondin, J. Thienpondt, B. Desplanques, H. Na,
@@ -18,19 +19,19 @@ Authors
  * Nauman Dawalatabad 2020
 """
 
-import glob
 import json
 import os
-import pickle
-import shutil
 import sys
+import zlib
 
 import numpy as np
 import torch
 from hyperpyyaml import load_hyperpyyaml
+from joblib import Parallel, delayed
 from tqdm.contrib import tqdm
 
 import speechbrain as sb
+from speechbrain.core import AMPConfig
 from speechbrain.dataio.dataio import read_audio, read_audio_multichannel
 from speechbrain.processing import diarization as diar
 from speechbrain.processing.PLDA_LDA import StatObject_SB
@@ -61,78 +62,339 @@ except ImportError:
 
 
 def compute_embeddings(wavs, lens):
-    """Definition of the steps for computation of embeddings from the waveforms."""
-    with torch.no_grad():
-        wavs = wavs.to(run_opts["device"])
+    """Definition of the steps for computation of embeddings from the waveforms.
+    The embedding model runs with the precision set by `embedding_precision`,
+    while the returned embeddings are always float32.
+    """
+    amp = AMPConfig.from_name(params["embedding_precision"])
+    with torch.no_grad(), torch.autocast(
+        device_type=torch.device(run_opts["device"]).type,
+        dtype=amp.dtype,
+        enabled=amp.dtype != torch.float32,
+    ):
+        wavs = wavs.to(run_opts["device"], non_blocking=True)
         feats = params["compute_features"](wavs)
+
+    return compute_embeddings_from_features(feats, lens)
+
+
+def compute_embeddings_from_features(feats, lens):
+    """Computes the embeddings from already extracted features (see
+    `compute_embeddings`).
+    """
+    amp = AMPConfig.from_name(params["embedding_precision"])
+    with torch.no_grad(), torch.autocast(
+        device_type=torch.device(run_opts["device"]).type,
+        dtype=amp.dtype,
+        enabled=amp.dtype != torch.float32,
+    ):
+        feats = feats.to(run_opts["device"], non_blocking=True)
         feats = params["mean_var_norm"](feats, lens)
         emb = params["embedding_model"](feats, lens)
-        emb = params["mean_var_norm_emb"](
-            emb, torch.ones(emb.shape[0], device=run_opts["device"])
-        )
 
-    return emb
+    return emb.float()
+
+
+def cached_feature_loader(meta_data):
+    """Iterates over batches of features of the sub-segments in `meta_data`.
+    The features of each audio file are computed once and sliced for each
+    sub-segment, instead of being computed again for the overlapping parts
+    of adjacent sub-segments. Sub-segments of different recordings can share
+    a batch, as with the dataloader.
+
+    Arguments
+    ---------
+    meta_data : dict
+        Meta-data (json) of the sub-segments.
+
+    Yields
+    ------
+    ids : list
+        Sub-segment IDs of the batch.
+    feats : torch.Tensor
+        Padded features of the batch, on the device.
+    lens : torch.Tensor
+        Relative lengths of the features.
+    """
+    hop_length = params["compute_features"].compute_STFT.hop_length
+    batch_size = params["dataloader_opts"]["batch_size"]
+
+    # Sub-segments grouped by audio file (a plain path means the whole file).
+    file_segs = {}
+    for seg_id, seg in meta_data.items():
+        wav = seg["wav"]
+        if isinstance(wav, str):
+            wav = {"file": wav}
+        path = wav["file"].replace("{data_root}", params["data_folder"])
+        start = wav.get("start", 0)
+        stop = wav.get("stop", start)
+        file_segs.setdefault(path, []).append((seg_id, start, stop))
+
+    ids, seg_feats = [], []
+    for path, segs in file_segs.items():
+        sig = read_audio(path).to(run_opts["device"])
+        with torch.no_grad():
+            rec_feats = params["compute_features"](sig.unsqueeze(0))[0]
+
+        for seg_id, start, stop in segs:
+            if stop == start:
+                stop = sig.shape[0]
+            if params["min_subseg_rms"] > 0 and is_silent(
+                sig[start:stop].unsqueeze(0), torch.ones(1)
+            ):
+                logger.debug("Skipping silent sub-segment %s." % seg_id)
+                continue
+
+            # Frames are centered every hop_length samples (as for the STFT
+            # of the sub-segment alone).
+            first_frame = int(round(start / hop_length))
+            num_frames = (stop - start) // hop_length + 1
+            ids.append(seg_id)
+            seg_feats.append(rec_feats[first_frame : first_frame + num_frames])
+
+            if len(ids) == batch_size:
+                yield ids, *_pad_features(seg_feats)
+                ids, seg_feats = [], []
+
+    if len(ids) > 0:
+        yield ids, *_pad_features(seg_feats)
+
+
+def _pad_features(seg_feats):
+    """Pads the features of sub-segments to a batch.
+
+    Arguments
+    ---------
+    seg_feats : list
+        Features of the sub-segments, each of shape [time, n_feats].
+
+    Returns
+    -------
+    feats : torch.Tensor
+        Padded features, shape [batch, time, n_feats].
+    lens : torch.Tensor
+        Relative lengths of the features.
+    """
+    feats = torch.nn.utils.rnn.pad_sequence(seg_feats, batch_first=True)
+    lens = torch.tensor([f.shape[0] / feats.shape[1] for f in seg_feats])
+    return feats, lens
+
+
+def is_silent(wavs, lens):
+    """Finds the (almost) silent waveforms, i.e., with an RMS energy below
+    `min_subseg_rms`. The padding is not taken into account.
+
+    Arguments
+    ---------
+    wavs : torch.Tensor
+        Batch of waveforms, shape [batch, time].
+    lens : torch.Tensor
+        Relative lengths of the waveforms.
+
+    Returns
+    -------
+    silent : torch.Tensor
+        Boolean mask of the silent waveforms.
+    """
+    num_samples = (lens.to(wavs.device) * wavs.shape[1]).round().clamp(min=1)
+    mask = (
+        torch.arange(wavs.shape[1], device=wavs.device) < num_samples[:, None]
+    )
+    energy = (wavs.pow(2) * mask).sum(dim=1) / num_samples
+    return energy.sqrt() < params["min_subseg_rms"]
+
+
+def prefetch_to_device(set_loader, device):
+    """Iterates over the batches of a loader, moving the waveforms to the
+    device. On CUDA, the (pinned) waveforms of the next batch are copied on a
+    separate stream, so that the copy overlaps with the current computation.
+
+    Arguments
+    ---------
+    set_loader : DataLoader
+        Loader yielding batches with `id` and `sig`.
+    device : str
+        Device where the waveforms are moved.
+
+    Yields
+    ------
+    ids : list
+        Sub-segment IDs of the batch.
+    wavs : torch.Tensor
+        Waveforms of the batch, on the device.
+    lens : torch.Tensor
+        Relative lengths of the waveforms.
+    """
+    device = torch.device(device)
+    copy_stream = None
+    if device.type == "cuda":
+        copy_stream = torch.cuda.Stream(device)
+
+    pending = None
+    for batch in set_loader:
+        wavs, lens = batch.sig
+        if copy_stream is None:
+            yield batch.id, wavs.to(device), lens
+            continue
+
+        with torch.cuda.stream(copy_stream):
+            wavs = wavs.to(device, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(copy_stream)
+
+        if pending is not None:
+            yield _wait_copy(*pending)
+        pending = (batch.id, wavs, lens, copied)
+
+    if pending is not None:
+        yield _wait_copy(*pending)
+
+
+def _wait_copy(ids, wavs, lens, copied):
+    """Makes the current stream wait for the copy of a prefetched batch.
+
+    Arguments
+    ---------
+    ids : list
+        Sub-segment IDs of the batch.
+    wavs : torch.Tensor
+        Waveforms of the batch, copied on another stream.
+    lens : torch.Tensor
+        Relative lengths of the waveforms.
+    copied : torch.cuda.Event
+        Event recorded after the copy of the waveforms.
+
+    Returns
+    -------
+    ids : list
+        Sub-segment IDs of the batch.
+    wavs : torch.Tensor
+        Waveforms of the batch, ready to be used on the current stream.
+    lens : torch.Tensor
+        Relative lengths of the waveforms.
+    """
+    current_stream = torch.cuda.current_stream(wavs.device)
+    current_stream.wait_event(copied)
+    # The memory of wavs must not be reused before the current stream is done.
+    wavs.record_stream(current_stream)
+    return ids, wavs, lens
 
 
-def embedding_computation_loop(split, set_loader, stat_file):
-    """Extracts embeddings for a given dataset loader."""
+def embedding_computation_loop(
+    split, set_loader, stat_files, from_features=False
+):
+    """Extracts embeddings for a given dataset loader.
+
+    The loader may span several recordings, so that sub-segments of different
+    recordings share the same forward pass. The embeddings are then split back
+    per recording, normalized, and stored in one StatObject_SB per recording.
+
+    Arguments
+    ---------
+    split : str
+        Name of the split under processing.
+    set_loader : DataLoader
+        Loader over the sub-segments of all the recordings in `stat_files`.
+    stat_files : dict
+        Mapping from recording ID to the path of its output stat file.
+    from_features : bool
+        Whether `set_loader` yields features (see `cached_feature_loader`)
+        instead of waveform batches.
+
+    Returns
+    -------
+    stat_objs : dict
+        Mapping from recording ID to its StatObject_SB.
+    """
 
     # Note: We use speechbrain.processing.PLDA_LDA.StatObject_SB type to store embeddings.
-    # Extract embeddings (skip if already done).
-    if not os.path.isfile(stat_file):
-        logger.debug("Extracting deep embeddings and diarizing")
-        embeddings = np.empty(shape=[0, params["emb_dim"]], dtype=np.float64)
-        modelset = []
-        segset = []
+    logger.debug("Extracting deep embeddings for %s" % split)
+    emb_chunks = []
+    segset = []
+
+    if from_features:
+        batches = set_loader
+        embed = compute_embeddings_from_features
+    else:
+        batches = prefetch_to_device(set_loader, run_opts["device"])
+        embed = compute_embeddings
+
+    num_silent = 0
+    for ids, inputs, lens in batches:
+        # Optionally skip the (almost) silent sub-segments (the feature loader
+        # already skips them).
+        if params["min_subseg_rms"] > 0 and not from_features:
+            keep = ~is_silent(inputs, lens).cpu()
+            num_silent += len(ids) - int(keep.sum())
+            ids = [seg_id for seg_id, k in zip(ids, keep.tolist()) if k]
+            inputs, lens = inputs[keep.to(inputs.device)], lens[keep]
+            if len(ids) == 0:
+                continue
+
+        segset.extend(ids)
 
+        # Embedding computation.
+        emb = embed(inputs, lens).contiguous().squeeze(1).cpu()
+        emb_chunks.append(emb)
+
+    if num_silent > 0:
+        logger.info("Skipped %d silent sub-segments." % num_silent)
+    if len(emb_chunks) > 0:
+        embeddings = torch.cat(emb_chunks, dim=0)
+    else:
+        embeddings = torch.empty(0, params["emb_dim"])
+
+    # Group the sub-segments by recording (the order within a recording is kept).
+    rec_idx = {}
+    for i, seg_id in enumerate(segset):
+        rec_idx.setdefault(seg_id.split("_")[0], []).append(i)
+
+    # Relative lengths of the embeddings (all 1), sliced for each recording.
+    ones = torch.ones(max((len(idx) for idx in rec_idx.values()), default=0))
+
+    stat_objs = {}
+    for rec_id, idx in rec_idx.items():
         # Different data may have different statistics.
+        # The embeddings are normalized as [batch, time=1, dim] so that the
+        # mean is computed (and removed) per dimension.
         params["mean_var_norm_emb"].count = 0
+        emb = embeddings[idx].unsqueeze(1)
+        emb = params["mean_var_norm_emb"](emb, ones[: emb.shape[0]])
+        emb = emb.squeeze(1).numpy()
 
-        for batch in set_loader:
-            ids = batch.id
-            wavs, lens = batch.sig
-
-            mod = [x for x in ids]
-            seg = [x for x in ids]
-            modelset = modelset + mod
-            segset = segset + seg
-
-            # Embedding computation.
-            emb = (
-                compute_embeddings(wavs, lens)
-                .contiguous()
-                .squeeze(1)
-                .cpu()
-                .numpy()
-            )
-            embeddings = np.concatenate((embeddings, emb), axis=0)
-
-        modelset = np.array(modelset, dtype="|O")
-        segset = np.array(segset, dtype="|O")
+        segs = np.array([segset[i] for i in idx], dtype="|O")
+        modelset = segs.copy()
 
         # Initialize variables for start, stop and stat0.
-        s = np.array([None] * embeddings.shape[0])
-        b = np.array([[1.0]] * embeddings.shape[0])
+        s = np.full(emb.shape[0], None, dtype=object)
+        b = np.ones((emb.shape[0], 1), dtype=emb.dtype)
 
         stat_obj = StatObject_SB(
             modelset=modelset,
-            segset=segset,
+            segset=segs,
             start=s,
             stop=s,
             stat0=b,
-            stat1=embeddings,
+            stat1=emb,
         )
         logger.debug("Saving Embeddings...")
-        stat_obj.save_stat_object(stat_file)
-
-    else:
-        logger.debug("Skipping embedding extraction (as already present).")
-        logger.debug("Loading previously saved embeddings.")
-
-        with open(stat_file, "rb") as in_file:
-            stat_obj = pickle.load(in_file)
+        stat_file = stat_files[rec_id]
+        stat_obj.save_stat_object(
+            stat_file, stat1_file=os.path.splitext(stat_file)[0] + ".npy"
+        )
+        stat_objs[rec_id] = stat_obj
+
+    # Recordings with only silent sub-segments (see `min_subseg_rms`) are
+    # saved empty, so that they are not processed again.
+    for rec_id in sorted(stat_files.keys() - rec_idx.keys()):
+        stat_obj = StatObject_SB()
+        stat_file = stat_files[rec_id]
+        stat_obj.save_stat_object(
+            stat_file, stat1_file=os.path.splitext(stat_file)[0] + ".npy"
+        )
+        stat_objs[rec_id] = stat_obj
 
-    return stat_obj
+    return stat_objs
 
 
 def prepare_subset_json(full_meta_data, rec_id, out_meta_file):
@@ -142,8 +404,8 @@ def prepare_subset_json(full_meta_data, rec_id, out_meta_file):
     ---------
     full_meta_data : json
         Full meta (json) containing all the recordings
-    rec_id : str
-        The recording ID for which meta (json) has to be prepared
+    rec_id : str or tuple
+        The recording ID (or IDs) for which meta (json) has to be prepared
     out_meta_file : str
         Path of the output meta (json) file.
     """
@@ -158,14 +420,145 @@ def prepare_subset_json(full_meta_data, rec_id, out_meta_file):
         json.dump(subset, json_f, indent=2)
 
 
-def diarize_dataset(full_meta, split_type, n_lambdas, pval, n_neighbors=10):
+def cluster_recording(
+    diary_obj,
+    out_rttm_file,
+    rec_id,
+    num_spkrs,
+    pval,
+    n_neighbors,
+    backend,
+    affinity,
+    device,
+    max_num_spkrs,
+    spec_cache=None,
+    max_samples=None,
+):
+    """Clusters the embeddings of one recording and writes its RTTM file.
+    It only depends on its arguments, so that recordings can be clustered
+    in parallel processes.
+
+    Arguments
+    ---------
+    diary_obj : StatObject_SB
+        Embeddings of the recording.
+    out_rttm_file : str
+        Path of the output RTTM file.
+    rec_id : str
+        Recording ID.
+    num_spkrs : int
+        Number of speakers (None, if it has to be estimated).
+    pval : float
+        p-value for pruning the affinity matrix (threshold for AHC).
+    n_neighbors : int
+        Number of neighbors of the nn affinity.
+    backend : str
+        Clustering backend (SC, kmeans or AHC).
+    affinity : str
+        Type of affinity of the SC backend (cos or nn).
+    device : str
+        Device used by the SC backend with nn affinity (None for CPU). Only
+        set it when the recordings are clustered in the main process.
+    max_num_spkrs : int
+        Number of spectral components cached for the nn affinity.
+    spec_cache : dict
+        Spectral cache of this recording (see diar.do_spec_clustering).
+    max_samples : int
+        Maximum number of sub-segments in the eigendecomposition of the nn
+        affinity (None for all).
+
+    Returns
+    -------
+    lines : list of str
+        The lines of the output RTTM file.
+    spec_cache : dict
+        The updated spectral cache (it is not shared across processes).
+    """
+    # The kmeans seed only depends on the recording, so that the results do not
+    # depend on the other recordings clustered by the same process.
+    random_state = zlib.crc32(rec_id.encode("utf-8"))
+
+    if backend == "kmeans":
+        lines = diar.do_kmeans_clustering(
+            diary_obj,
+            out_rttm_file,
+            rec_id,
+            num_spkrs,
+            pval,
+            random_state=random_state,
+        )
+
+    if backend == "SC":
+        # Go for Spectral Clustering (SC).
+        lines = diar.do_spec_clustering(
+            diary_obj,
+            out_rttm_file,
+            rec_id,
+            num_spkrs,
+            pval,
+            affinity,
+            n_neighbors,
+            device=device,
+            spec_cache=spec_cache,
+            n_components=max_num_spkrs,
+            max_samples=max_samples,
+            random_state=random_state,
+        )
+
+    # Can used for AHC later. Likewise one can add different backends here.
+    if backend == "AHC":
+        # call AHC
+        threshold = pval  # pval for AHC is nothing but threshold.
+        lines = diar.do_AHC(
+            diary_obj, out_rttm_file, rec_id, num_spkrs, threshold
+        )
+
+    return lines, spec_cache
+
+
+def min_num_subsegs(num_spkrs, n_neighbors, cached):
+    """Returns the minimum number of sub-segments of a recording for the
+    clustering backend (kmeans needs at least one sub-segment per speaker, the
+    nn affinity also needs n_neighbors of them and more than the number of
+    spectral components).
+
+    Arguments
+    ---------
+    num_spkrs : int
+        Number of speakers (None, if it has to be estimated).
+    n_neighbors : int
+        Number of neighbors of the nn affinity.
+    cached : bool
+        Whether the spectral embeddings are cached (then computed for
+        max_num_spkrs components).
+
+    Returns
+    -------
+    min_subsegs : int
+        The minimum number of sub-segments.
+    """
+    # At least 2 speakers are estimated when the number is unknown.
+    min_subsegs = 2 if num_spkrs is None else num_spkrs
+    if params["backend"] == "SC" and params["affinity"] == "nn":
+        n_components = min_subsegs
+        if cached:
+            n_components = max(n_components, params["max_num_spkrs"])
+        min_subsegs = max(min_subsegs, n_neighbors, n_components + 1)
+    return min_subsegs
+
+
+def diarize_dataset(
+    full_meta, split_type, n_lambdas, pval, n_neighbors=10, spec_cache=None
+):
     """This function diarizes all the recordings in a given dataset. It performs
     computation of embedding and clusters them using spectral clustering (or other backends).
     The output speaker boundary file is stored in the RTTM format.
+    When `spec_cache` (dict) is given, the spectral embeddings of the nn affinity
+    are cached in it across calls (see diar.do_spec_clustering).
     """
 
-    # Prepare `spkr_info` only once when Oracle num of speakers is selected.
-    # spkr_info is essential to obtain number of speakers from groundtruth.
+    # Prepare the number of speakers of each recording only once when Oracle
+    # num of speakers is selected (obtained from the groundtruth `spkr_info`).
     if params["oracle_n_spkrs"] is True:
         full_ref_rttm_file = (
             params["ref_rttm_dir"] + "/fullref_ami_" + split_type + ".rttm"
@@ -173,9 +566,8 @@ def diarize_dataset(full_meta, split_type, n_lambdas, pval, n_neighbors=10):
 
         rttm = diar.read_rttm(full_ref_rttm_file)
 
-        spkr_info = list(  # noqa F841
-            filter(lambda x: x.startswith("SPKR-INFO"), rttm)
-        )
+        spkr_info = [line for line in rttm if line.startswith("SPKR-INFO")]
+        oracle_num_spkrs = diar.get_oracle_num_spkrs_per_rec(spkr_info)
 
     # Get all the recording IDs in this dataset.
     all_keys = full_meta.keys()
@@ -194,78 +586,108 @@ def diarize_dataset(full_meta, split_type, n_lambdas, pval, n_neighbors=10):
         msg = "No recording IDs found! Please check if meta_data json file is properly generated."
         raise ValueError(msg)
 
-    # Diarizing different recordings in a dataset.
-    for rec_id in tqdm(all_rec_ids):
-        # This tag will be displayed in the log.
-        tag = (
-            "["
-            + str(split_type)
-            + ": "
-            + str(i)
-            + "/"
-            + str(len(all_rec_ids))
-            + "]"
-        )
-        i = i + 1
-
-        # Log message.
-        msg = "Diarizing %s : %s " % (tag, rec_id)
-        logger.debug(msg)
-
-        # Embedding directory.
-        if not os.path.exists(os.path.join(params["embedding_dir"], split)):
-            os.makedirs(os.path.join(params["embedding_dir"], split))
+    # Embedding directory.
+    emb_dir = os.path.join(params["embedding_dir"], split)
+    if not os.path.exists(emb_dir):
+        os.makedirs(emb_dir)
 
-        # File to store embeddings.
+    # Files to store embeddings.
+    stat_files = {}
+    for rec_id in all_rec_ids:
         emb_file_name = rec_id + "." + params["mic_type"] + ".emb_stat.pkl"
-        diary_stat_emb_file = os.path.join(
-            params["embedding_dir"], split, emb_file_name
-        )
+        stat_files[rec_id] = os.path.join(emb_dir, emb_file_name)
 
         # Prepare a metadata (json) for one recording. This is basically a subset of full_meta.
         # Lets keep this meta-info in embedding directory itself.
         json_file_name = rec_id + "." + params["mic_type"] + ".json"
-        meta_per_rec_file = os.path.join(
-            params["embedding_dir"], split, json_file_name
-        )
+        meta_per_rec_file = os.path.join(emb_dir, json_file_name)
 
         # Write subset (meta for one recording) json metadata.
         prepare_subset_json(full_meta, rec_id, meta_per_rec_file)
 
-        # Prepare data loader.
-        diary_set_loader = dataio_prep(params, meta_per_rec_file)
+    # Compute Embeddings (skip the recordings already done).
+    # Sub-segments of all the remaining recordings are batched together.
+    pending_files = {
+        rec_id: stat_file
+        for rec_id, stat_file in stat_files.items()
+        if not os.path.isfile(stat_file)
+    }
+    diary_objs = {}
+    if len(pending_files) > 0:
+        json_file_name = split + "." + params["mic_type"] + ".json"
+        meta_pending_file = os.path.join(emb_dir, json_file_name)
+        prepare_subset_json(full_meta, tuple(pending_files), meta_pending_file)
+
+        # Prepare data loader. With `cache_features`, features are computed
+        # once per audio file (not supported by the multi-mic beamformer,
+        # which works on sub-segments).
+        from_features = params["cache_features"]
+        if from_features and params["mic_type"] == "Array1":
+            logger.warning("cache_features is not supported with Array1.")
+            from_features = False
+
+        if from_features:
+            with open(meta_pending_file, encoding="utf-8") as f:
+                diary_set_loader = cached_feature_loader(json.load(f))
+        else:
+            diary_set_loader = dataio_prep(params, meta_pending_file)
 
         # Putting modules on the device.
         params["compute_features"].to(run_opts["device"])
         params["mean_var_norm"].to(run_opts["device"])
         params["embedding_model"].to(run_opts["device"])
-        params["mean_var_norm_emb"].to(run_opts["device"])
 
-        # Compute Embeddings.
-        diary_obj = embedding_computation_loop(
-            "diary", diary_set_loader, diary_stat_emb_file
+        diary_objs = embedding_computation_loop(
+            "diary", diary_set_loader, pending_files, from_features
         )
 
-        # Adding tag for directory path.
-        type_of_num_spkr = "oracle" if params["oracle_n_spkrs"] else "est"
+    # Adding tag for directory path.
+    type_of_num_spkr = "oracle" if params["oracle_n_spkrs"] else "est"
+    tag = (
+        type_of_num_spkr
+        + "_"
+        + str(params["affinity"])
+        + "_"
+        + params["backend"]
+    )
+    out_rttm_dir = os.path.join(
+        params["sys_rttm_dir"], params["mic_type"], split, tag
+    )
+    os.makedirs(out_rttm_dir, exist_ok=True)
+
+    # Diarizing different recordings in a dataset.
+    jobs = []
+    for rec_id in tqdm(all_rec_ids):
+        # This tag will be displayed in the log.
         tag = (
-            type_of_num_spkr
-            + "_"
-            + str(params["affinity"])
-            + "_"
-            + params["backend"]
-        )
-        out_rttm_dir = os.path.join(
-            params["sys_rttm_dir"], params["mic_type"], split, tag
+            "["
+            + str(split_type)
+            + ": "
+            + str(i)
+            + "/"
+            + str(len(all_rec_ids))
+            + "]"
         )
-        if not os.path.exists(out_rttm_dir):
-            os.makedirs(out_rttm_dir)
+        i = i + 1
+
+        # Log message.
+        msg = "Diarizing %s : %s " % (tag, rec_id)
+        logger.debug(msg)
+
+        if rec_id in diary_objs:
+            diary_obj = diary_objs[rec_id]
+        else:
+            logger.debug("Skipping embedding extraction (as already present).")
+            logger.debug("Loading previously saved embeddings.")
+
+            diary_obj = StatObject_SB.load_stat_object(stat_files[rec_id])
+
         out_rttm_file = out_rttm_dir + "/" + rec_id + ".rttm"
 
         # Processing starts from here.
         if params["oracle_n_spkrs"] is True:
             # Oracle num of speakers.
-            num_spkrs = diar.get_oracle_num_spkrs(rec_id, spkr_info)
+            num_spkrs = oracle_num_spkrs[rec_id]
         else:
             if params["affinity"] == "nn":
                 # Num of speakers tuned on dev set (only for nn affinity).
@@ -275,39 +697,64 @@ def diarize_dataset(full_meta, split_type, n_lambdas, pval, n_neighbors=10):
                 # So adding None here. Will use this None later-on.
                 num_spkrs = None
 
-        if params["backend"] == "kmeans":
-            diar.do_kmeans_clustering(
-                diary_obj, out_rttm_file, rec_id, num_spkrs, pval
+        # Recordings with too few sub-segments (e.g., after skipping the silent
+        # ones, see `min_subseg_rms`) cannot be clustered.
+        num_subsegs = len(diary_obj.segset)
+        min_subsegs = min_num_subsegs(
+            num_spkrs, n_neighbors, spec_cache is not None
+        )
+        if num_subsegs < min_subsegs:
+            msg = "%s has %d sub-segments (at least %d needed), skipping it."
+            logger.warning(msg % (rec_id, num_subsegs, min_subsegs))
+            continue
+
+        # Recordings are clustered independently (see `cluster_recording`).
+        rec_cache = None
+        if spec_cache is not None:
+            rec_cache = (
+                {rec_id: spec_cache[rec_id]} if rec_id in spec_cache else {}
             )
-
-        if params["backend"] == "SC":
-            # Go for Spectral Clustering (SC).
-            diar.do_spec_clustering(
+        jobs.append(
+            delayed(cluster_recording)(
                 diary_obj,
                 out_rttm_file,
                 rec_id,
                 num_spkrs,
                 pval,
-                params["affinity"],
                 n_neighbors,
+                params["backend"],
+                params["affinity"],
+                params["clustering_device"],
+                params["max_num_spkrs"],
+                spec_cache=rec_cache,
+                max_samples=params["spectral_max_samples"],
             )
+        )
 
-        # Can used for AHC later. Likewise one can add different backends here.
-        if params["backend"] == "AHC":
-            # call AHC
-            threshold = pval  # pval for AHC is nothing but threshold.
-            diar.do_AHC(diary_obj, out_rttm_file, rec_id, num_spkrs, threshold)
+    if len(jobs) == 0:
+        msg = (
+            "No recording left to diarize in the %s set (see the warnings "
+            "above and min_subseg_rms)." % split_type
+        )
+        raise ValueError(msg)
+
+    # Clustering of the different recordings (CPU-bound, run in parallel).
+    # With a clustering device, it runs in this process only, so that each
+    # worker does not create its own GPU context.
+    n_jobs = params["n_jobs"]
+    if params["clustering_device"] is not None:
+        n_jobs = 1
+    results = Parallel(n_jobs=n_jobs, backend="loky")(jobs)
 
-    # Once all RTTM outputs are generated, concatenate individual RTTM files to obtain single RTTM file.
+    # Also write the RTTM lines of all the recordings in a single RTTM file.
     # This is not needed but just staying with the standards.
     concate_rttm_file = out_rttm_dir + "/sys_output.rttm"
     logger.debug("Concatenating individual RTTM files...")
     with open(concate_rttm_file, "w", encoding="utf-8") as cat_file:
-        for f in glob.glob(out_rttm_dir + "/*.rttm"):
-            if f == concate_rttm_file:
-                continue
-            with open(f, "r", encoding="utf-8") as indi_rttm_file:
-                shutil.copyfileobj(indi_rttm_file, cat_file)
+        for lines, rec_cache in results:
+            cat_file.writelines(lines)
+            if spec_cache is not None:
+                spec_cache.update(rec_cache)
 
     msg = "The system generated RTTM file for %s set : %s" % (
         split_type,
@@ -435,10 +882,16 @@ def dev_tuner(full_meta, split_type):
 
     DER_list = []
     pval = None
+
+    # The affinity matrices and spectral embeddings do not depend on n_lambdas,
+    # they are computed once (for max_num_spkrs components) and reused, and
+    # kmeans is warm-started across n_lambdas. The final run only clusters the
+    # same way with `nn_incremental_kmeans`.
+    spec_cache = {}
     for n_lambdas in range(1, params["max_num_spkrs"] + 1):
         # Process whole dataset for value of n_lambdas.
         concate_rttm_file = diarize_dataset(
-            full_meta, split_type, n_lambdas, pval
+            full_meta, split_type, n_lambdas, pval, spec_cache=spec_cache
         )
 
         ref_rttm = os.path.join(params["ref_rttm_dir"], "fullref_ami_dev.rttm")
@@ -630,6 +1083,7 @@ if __name__ == "__main__":  # noqa: C901
             n_lambdas=n_lambdas,
             pval=best_pval,
             n_neighbors=best_nn,
+            spec_cache={} if params["nn_incremental_kmeans"] else None,
         )
 
         # Computing DER.
@@ -21,6 +21,7 @@ Credits
 """
 
 import copy
+import os
 import pickle
 
 import numpy
@@ -88,16 +89,81 @@ class StatObject_SB:
         ch += "-" * 30 + "\n"
         return ch
 
-    def save_stat_object(self, filename):
+    def save_stat_object(self, filename, stat1_file=None):
         """Saves stats in pickle format.
 
         Arguments
         ---------
         filename : path
             Path where the pickle file will be stored.
+        stat1_file : path
+            If given, stat1 is stored in this .npy file instead of the pickle,
+            so that `load_stat_object` can memory-map it.
+
+        Example
+        -------
+        >>> stat = StatObject_SB(
+        ...     modelset=numpy.array(["m1", "m2"], dtype="|O"),
+        ...     segset=numpy.array(["s1", "s2"], dtype="|O"),
+        ...     start=numpy.array([None, None]),
+        ...     stop=numpy.array([None, None]),
+        ...     stat0=numpy.ones((2, 1)),
+        ...     stat1=numpy.arange(6.0).reshape(2, 3),
+        ... )
+        >>> pkl_file = str(getfixture("tmpdir") / "stat.pkl")
+        >>> npy_file = str(getfixture("tmpdir") / "stat1.npy")
+        >>> stat.save_stat_object(pkl_file, stat1_file=npy_file)
+        >>> StatObject_SB.load_stat_object(pkl_file).stat1
+        memmap([[0., 1., 2.],
+                [3., 4., 5.]])
         """
+        if stat1_file is not None:
+            numpy.save(stat1_file, self.stat1, allow_pickle=False)
+
+            # The pickle only keeps the meta-information and the path of
+            # stat1 (relative to the pickle, so the directory can be moved).
+            meta = copy.copy(self)
+            meta.stat1 = None
+            meta.stat1_file = os.path.relpath(
+                stat1_file, os.path.dirname(os.path.abspath(filename))
+            )
+        else:
+            meta = self
+
         with open(filename, "wb") as output:
-            pickle.dump(self, output, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(meta, output, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load_stat_object(filename, mmap_mode="r"):
+        """Loads stats saved with `save_stat_object`.
+
+        Arguments
+        ---------
+        filename : path
+            Path of the pickle file.
+        mmap_mode : str
+            Memory-map mode used for stat1 when it was stored in a separate
+            .npy file (see `numpy.load`). None loads it in memory.
+
+        Returns
+        -------
+        stat : StatObject_SB
+            The loaded object.
+        """
+        with open(filename, "rb") as in_file:
+            stat = pickle.load(in_file)
+
+        stat1_file = getattr(stat, "stat1_file", None)
+        if stat1_file is not None:
+            stat1_file = os.path.join(
+                os.path.dirname(os.path.abspath(filename)), stat1_file
+            )
+            stat.stat1 = numpy.load(
+                stat1_file, mmap_mode=mmap_mode, allow_pickle=False
+            )
+            del stat.stat1_file
+
+        return stat
 
     def get_model_segsets(self, mod_id):
         """Return segments of a given model.
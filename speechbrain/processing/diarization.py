@@ -24,6 +24,7 @@ import warnings
 
 import numpy as np
 import scipy
+import torch
 from scipy import sparse
 from scipy.sparse.csgraph import connected_components
 from scipy.sparse.csgraph import laplacian as csgraph_laplacian
@@ -48,6 +49,17 @@ except ImportError:
     err_msg += "conda install scikit-learn"
     raise ImportError(err_msg)
 
+# Optional support for FAISS (faster k-nearest-neighbors search)
+try:
+    import faiss
+
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+# GPU resources of FAISS, allocated once on first use (see kneighbors_graph_sb)
+_faiss_gpu_resources = None
+
 
 def read_rttm(rttm_file_path):
     """Reads and returns RTTM in list format.
@@ -185,33 +197,48 @@ def merge_ssegs_same_speaker(lol):
     >>> diar.merge_ssegs_same_speaker(lol)
     [['r1', 5.5, 11.0, 's1'], ['r1', 11.5, 13.0, 's2'], ['r1', 14.0, 15.0, 's2'], ['r1', 14.5, 15.0, 's1']]
     """
-    new_lol = []
-
-    # Start from the first sub-seg
-    sseg = lol[0]
-    flag = False
-    for i in range(1, len(lol)):
-        next_sseg = lol[i]
-
-        # IF sub-segments overlap AND has same speaker THEN merge
-        if is_overlapped(sseg[2], next_sseg[1]) and sseg[3] == next_sseg[3]:
-            sseg[2] = next_sseg[2]  # just update the end time
-            # This is important. For the last sseg, if it is the same speaker the merge
-            # Make sure we don't append the last segment once more. Hence, set FLAG=True
-            if i == len(lol) - 1:
-                flag = True
-                new_lol.append(sseg)
-        else:
-            new_lol.append(sseg)
-            sseg = next_sseg
+    starts = np.array([sseg[1] for sseg in lol], dtype=float)
+    ends = np.array([sseg[2] for sseg in lol], dtype=float)
+    spkrs = np.array([sseg[3] for sseg in lol])
+    first, last = _merge_ssegs_idx(starts, ends, spkrs)
 
-    # Add last segment only when it was skipped earlier.
-    if flag is False:
-        new_lol.append(lol[-1])
+    new_lol = [
+        [lol[f][0], lol[f][1], lol[l][2], lol[f][3]]
+        for f, l in zip(first.tolist(), last.tolist())
+    ]
 
     return new_lol
 
 
+def _merge_ssegs_idx(starts, ends, spkrs):
+    """Finds the groups of adjacent sub-segs from the same speaker
+    (see `merge_ssegs_same_speaker`).
+
+    Arguments
+    ---------
+    starts : numpy.ndarray
+        Start times of the sub-segs (sorted).
+    ends : numpy.ndarray
+        End times of the sub-segs.
+    spkrs : numpy.ndarray
+        Speaker of the sub-segs.
+
+    Returns
+    -------
+    first : numpy.ndarray
+        Index of the first sub-seg of each merged segment.
+    last : numpy.ndarray
+        Index of the last sub-seg of each merged segment.
+    """
+    # A sub-seg is merged with the previous one when they overlap and have the
+    # same speaker (the end time of a merged group is always the end time of
+    # its last sub-seg, so comparing each sub-seg with the previous is enough).
+    merged = (starts[1:] <= ends[:-1]) & (spkrs[1:] == spkrs[:-1])
+    first = np.flatnonzero(np.concatenate(([True], ~merged)))
+    last = np.append(first[1:] - 1, len(starts) - 1)
+    return first, last
+
+
 def distribute_overlap(lol):
     """Distributes the overlapped speech equally among the adjacent segments
     with different speakers.
@@ -237,57 +264,114 @@ def distribute_overlap(lol):
     >>> diar.distribute_overlap(lol)
     [['r1', 5.5, 8.5, 's1'], ['r1', 8.5, 11.0, 's2'], ['r1', 11.5, 12.5, 's2'], ['r1', 12.5, 15.0, 's1']]
     """
-    new_lol = []
-    sseg = lol[0]
+    starts = np.array([sseg[1] for sseg in lol], dtype=float)
+    ends = np.array([sseg[2] for sseg in lol], dtype=float)
+    starts, ends = _distribute_overlap_times(starts, ends)
 
-    # Add first sub-segment here to avoid error at: "if new_lol[-1] != sseg:" when new_lol is empty
-    # new_lol.append(sseg)
+    new_lol = [
+        [sseg[0], start, end, sseg[3]]
+        for sseg, start, end in zip(lol, starts.tolist(), ends.tolist())
+    ]
 
-    for i in range(1, len(lol)):
-        next_sseg = lol[i]
-        # No need to check if they are different speakers.
-        # Because if segments are overlapped then they always have different speakers.
-        # This is because similar speaker's adjacent sub-segments are already merged by "merge_ssegs_same_speaker()"
+    return new_lol
 
-        if is_overlapped(sseg[2], next_sseg[1]):
 
-            # Get overlap duration.
-            # Now this overlap will be divided equally between adjacent segments.
-            overlap = sseg[2] - next_sseg[1]
+def _distribute_overlap_times(starts, ends):
+    """Splits the overlaps of adjacent segments at their mid-point
+    (see `distribute_overlap`).
 
-            # Update end time of old seg
-            sseg[2] = sseg[2] - (overlap / 2.0)
+    Arguments
+    ---------
+    starts : numpy.ndarray
+        Start times of the segments (sorted).
+    ends : numpy.ndarray
+        End times of the segments.
 
-            # Update start time of next seg
-            next_sseg[1] = next_sseg[1] + (overlap / 2.0)
+    Returns
+    -------
+    starts : numpy.ndarray
+        Updated start times.
+    ends : numpy.ndarray
+        Updated end times.
+    """
+    # No need to check if they are different speakers.
+    # Because if segments are overlapped then they always have different speakers.
+    # This is because similar speaker's adjacent sub-segments are already merged by "merge_ssegs_same_speaker()"
+    overlap = ends[:-1] - starts[1:]
+    half_overlap = np.where(starts[1:] <= ends[:-1], overlap / 2.0, 0.0)
+    starts = np.concatenate((starts[:1], starts[1:] + half_overlap))
+    ends = np.concatenate((ends[:-1] - half_overlap, ends[-1:]))
+    return starts, ends
 
-            if len(new_lol) == 0:
-                # For first sub-segment entry
-                new_lol.append(sseg)
-            else:
-                # To avoid duplicate entries
-                if new_lol[-1] != sseg:
-                    new_lol.append(sseg)
 
-            # Current sub-segment is next sub-segment
-            sseg = next_sseg
+def labels_to_segments(subseg_ids, labels, rec_id, postprocess=False):
+    """Converts the cluster labels of sub-segments into a list of speaker
+    segments sorted by start time. Sub-segment IDs are expected in the
+    format `recID_start_end`.
 
-        else:
-            # For the first sseg
-            if len(new_lol) == 0:
-                new_lol.append(sseg)
-            else:
-                # To avoid duplicate entries
-                if new_lol[-1] != sseg:
-                    new_lol.append(sseg)
+    Arguments
+    ---------
+    subseg_ids : numpy.ndarray
+        Sub-segment IDs (e.g. diary_obj.segset).
+    labels : numpy.ndarray
+        Cluster label of each sub-segment.
+    rec_id : str
+        Recording ID, used as prefix of the speaker IDs.
+    postprocess : bool
+        If True, adjacent sub-segments of the same speaker are merged and the
+        overlaps between different speakers are split at their mid-point (as
+        `merge_ssegs_same_speaker` followed by `distribute_overlap`).
 
-            # Update the current sub-segment
-            sseg = next_sseg
+    Returns
+    -------
+    lol : list of list
+        Each list contains [rec_id, sseg_start, sseg_end, spkr_id].
 
-    # Add the remaining last sub-segment
-    new_lol.append(next_sseg)
+    Example
+    -------
+    >>> import numpy as np
+    >>> from speechbrain.processing import diarization as diar
+    >>> ids = np.array(['r1_2.0_4.5', 'r1_0.0_2.5', 'r1_4.0_6.0'])
+    >>> diar.labels_to_segments(ids, np.array([1, 0, 1]), 'r1')
+    [['r1', 0.0, 2.5, 'r1_0'], ['r1', 2.0, 4.5, 'r1_1'], ['r1', 4.0, 6.0, 'r1_1']]
+    >>> diar.labels_to_segments(ids, np.array([1, 0, 1]), 'r1', postprocess=True)
+    [['r1', 0.0, 2.25, 'r1_0'], ['r1', 2.25, 6.0, 'r1_1']]
+    """
+    # Parse all the IDs at once: "recID_start_end" -> (recID_start, end)
+    head = np.char.rpartition(np.asarray(subseg_ids, dtype=str), "_")
+    rec_start = np.char.rpartition(head[:, 0], "_")
+    starts = rec_start[:, 2].astype(float)
+    ends = head[:, 2].astype(float)
+    rec_ids = rec_start[:, 0]
+    labels = np.asarray(labels)
 
-    return new_lol
+    # Sorting based on start time of sub-segment
+    order = np.argsort(starts, kind="stable")
+    rec_ids, starts, ends = rec_ids[order], starts[order], ends[order]
+    labels = labels[order]
+
+    if postprocess:
+        # Merge and split in 2 simple steps: (i) Merge sseg of same speakers then (ii) split different speakers
+        # Step 1: Merge adjacent sub-segments that belong to same speaker (or cluster)
+        first, last = _merge_ssegs_idx(starts, ends, labels)
+        rec_ids, starts, ends = rec_ids[first], starts[first], ends[last]
+        labels = labels[first]
+
+        # Step 2: Distribute duration of adjacent overlapping sub-segments belonging to different speakers (or cluster)
+        # Taking mid-point as the splitting time location.
+        starts, ends = _distribute_overlap_times(starts, ends)
+
+    spkr_ids = np.char.add(rec_id + "_", labels.astype(str))
+
+    return [
+        list(seg)
+        for seg in zip(
+            rec_ids.tolist(),
+            starts.tolist(),
+            ends.tolist(),
+            spkr_ids.tolist(),
+        )
+    ]
 
 
 def write_rttm(segs_list, out_rttm_file):
@@ -299,6 +383,12 @@ def write_rttm(segs_list, out_rttm_file):
         Each list contains [rec_id, sseg_start, sseg_end, spkr_id].
     out_rttm_file : str
         Path of the output RTTM file.
+
+    Returns
+    -------
+    lines : list of str
+        The lines written in the RTTM file (e.g., to also append them to a
+        file with all the recordings).
     """
     rttm = []
     rec_id = segs_list[0][0]
@@ -318,10 +408,11 @@ def write_rttm(segs_list, out_rttm_file):
         ]
         rttm.append(new_row)
 
+    lines = ["%s\n" % " ".join(row) for row in rttm]
     with open(out_rttm_file, "w", encoding="utf-8") as f:
-        for row in rttm:
-            line_str = " ".join(row)
-            f.write("%s\n" % line_str)
+        f.writelines(lines)
+
+    return lines
 
 
 #######################################
@@ -418,21 +509,24 @@ def _set_diag(laplacian, value, norm_laplacian):
         if norm_laplacian:
             laplacian.flat[:: n_nodes + 1] = value
     else:
-        laplacian = laplacian.tocoo()
+        # The laplacian stays sparse. In csr format, setdiag only overwrites
+        # the stored diagonal entries, but inserting the missing ones is
+        # O(nnz) (hence the efficiency warning, silenced here).
+        laplacian = laplacian.tocsr()
         if norm_laplacian:
-            diag_idx = laplacian.row == laplacian.col
-            laplacian.data[diag_idx] = value
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", sparse.SparseEfficiencyWarning)
+                laplacian.setdiag(value)
         # If the matrix has a small number of diagonals (as in the
         # case of structured matrices coming from images), the
         # dia format might be best suited for matvec products:
-        n_diags = np.unique(laplacian.row - laplacian.col).size
+        rows = np.repeat(np.arange(n_nodes), np.diff(laplacian.indptr))
+        n_diags = np.unique(rows - laplacian.indices).size
         if n_diags <= 7:
             # 3 or less outer diagonals on each side
             laplacian = laplacian.todia()
-        else:
-            # csr has the fastest matvec and is thus best suited to
-            # arpack
-            laplacian = laplacian.tocsr()
+        # Otherwise, csr has the fastest matvec and is thus best suited to
+        # arpack
     return laplacian
 
 
@@ -457,6 +551,88 @@ def _deterministic_vector_sign_flip(u):
     return u
 
 
+def _warm_start_centroids(X, prev_labels, k):
+    """Initial centroids for kmeans with k clusters, computed from the labels
+    of a previous clustering of the same samples (e.g. with k - 1 clusters).
+    Clusters are dropped (smallest first) or added (the sample farthest from
+    its centroid) until k centroids remain.
+
+    Arguments
+    ---------
+    X : array (n_samples, n_features)
+        Samples to cluster.
+    prev_labels : array (n_samples,)
+        Labels of the previous clustering.
+    k : int
+        Number of centroids to return.
+
+    Returns
+    -------
+    centroids : array (k, n_features)
+        Initial centroids.
+
+    Example
+    -------
+    >>> import numpy as np
+    >>> X = np.array([[0.0], [0.1], [5.0], [5.1], [9.0]])
+    >>> _warm_start_centroids(X, np.array([0, 0, 1, 1, 1]), 3)
+    array([[0.05      ],
+           [6.36666667],
+           [9.        ]])
+    """
+    clusters, counts = np.unique(prev_labels, return_counts=True)
+    clusters = clusters[np.argsort(-counts, kind="stable")][:k]
+    centroids = [X[prev_labels == c].mean(axis=0) for c in np.sort(clusters)]
+    centroids = np.array(centroids)
+
+    while centroids.shape[0] < k:
+        dist = ((X[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=-1)
+        farthest = np.argmax(dist.min(axis=1))
+        centroids = np.vstack([centroids, X[farthest]])
+
+    return centroids
+
+
+def _incremental_kmeans(maps, k, prev_labels, random_state):
+    """Clusters the spectral embeddings into 1, 2, ..., k clusters, the i
+    first components being used for i clusters. Each kmeans is run once with
+    k-means++ init and once warm-started from the previous number of clusters
+    (see `_warm_start_centroids`), and the best fit is kept. The labels of a
+    previous call are reused, so that sweeping k only runs the missing fits,
+    and the labels for k do not depend on the order of the calls.
+
+    Arguments
+    ---------
+    maps : array (n_samples, n_components)
+        Spectral embeddings, with n_components >= k.
+    k : int
+        Largest number of clusters.
+    prev_labels : list of arrays
+        Labels for 1, 2, ... clusters returned by a previous call on the same
+        embeddings (may be empty).
+    random_state : int
+        Seed of the k-means++ init.
+
+    Returns
+    -------
+    labels : list of arrays
+        Labels for 1, 2, ..., (at least) k clusters.
+    """
+    labels = list(prev_labels)
+    for i in range(len(labels) + 1, k + 1):
+        X = maps[:, :i]
+        _, best_labels, best_inertia = k_means(
+            X, i, init="k-means++", n_init=1, random_state=random_state
+        )
+        if i > 1:
+            init = _warm_start_centroids(X, labels[-1], i)
+            _, warm_labels, warm_inertia = k_means(X, i, init=init, n_init=1)
+            if warm_inertia < best_inertia:
+                best_labels = warm_labels
+        labels.append(best_labels)
+    return labels
+
+
 def _check_random_state(seed):
     """Turn seed into a np.random.RandomState instance.
 
@@ -483,6 +659,59 @@ def _check_random_state(seed):
     )
 
 
+def _smallest_eigvecs_torch(laplacian, n_components, device):
+    """Returns the eigenvectors associated with the n_components smallest
+    eigenvalues of the (normalized) laplacian, computed with torch on the
+    given device. torch.lobpcg is used on the sparse 2*I - laplacian (same
+    eigenvectors, largest eigenvalues) in single precision, and a dense eigh
+    is used for very small graphs.
+
+    Arguments
+    ---------
+    laplacian : array or sparse matrix
+        The normalized graph laplacian (with unit diagonal).
+    n_components : int
+        Number of eigenvectors to compute.
+    device : str
+        The device used for the computation (e.g., "cuda:0").
+
+    Returns
+    -------
+    eig_vecs : array (n_samples, n_components)
+        The eigenvectors, sorted by decreasing eigenvalue of the laplacian
+        (i.e., as returned by `eigsh` on -laplacian).
+    """
+    n_samples = laplacian.shape[0]
+    # The matrix is kept sparse (only its non-zero entries are sent to the
+    # device).
+    A = (2 * sparse.identity(n_samples) - sparse.csr_matrix(laplacian)).tocoo()
+    A = torch.sparse_coo_tensor(
+        np.vstack((A.row, A.col)),
+        A.data,
+        size=A.shape,
+        dtype=torch.float32,
+        device=device,
+    )
+
+    # lobpcg requires the matrix to be at least 3 times larger than n_components
+    if n_samples < 3 * n_components:
+        vals, vecs = torch.linalg.eigh(A.to_dense())
+        vals, vecs = vals[-n_components:], vecs[:, -n_components:]
+    else:
+        generator = torch.Generator(device=device).manual_seed(1234)
+        X = torch.randn(
+            n_samples,
+            n_components,
+            dtype=A.dtype,
+            device=device,
+            generator=generator,
+        )
+        vals, vecs = torch.lobpcg(A, X=X, largest=True)
+
+    vecs = vecs[:, torch.argsort(vals)]
+    return vecs.cpu().numpy().astype(np.float64)
+
+
 #####################
 
 
@@ -526,11 +755,45 @@ def get_oracle_num_spkrs(rec_id, spkr_info):
     return num_spkrs
 
 
+def get_oracle_num_spkrs_per_rec(spkr_info):
+    """
+    Returns the actual number of speakers of all the recordings from the
+    ground-truth, reading the RTTM header only once (instead of calling
+    `get_oracle_num_spkrs` for each recording).
+
+    Arguments
+    ---------
+    spkr_info : list
+        Header of the RTTM file. Starting with `SPKR-INFO`.
+
+    Returns
+    -------
+    num_spkrs : dict
+        Mapping from recording ID to its number of speakers.
+
+    Example
+    -------
+    >>> from speechbrain.processing import diarization as diar
+    >>> spkr_info = ['SPKR-INFO ES2011a 0 <NA> <NA> <NA> unknown ES2011a.A <NA> <NA>',
+    ... 'SPKR-INFO ES2011a 0 <NA> <NA> <NA> unknown ES2011a.B <NA> <NA>',
+    ... 'SPKR-INFO ES2011b 0 <NA> <NA> <NA> unknown ES2011b.A <NA> <NA>']
+    >>> diar.get_oracle_num_spkrs_per_rec(spkr_info)
+    {'ES2011a': 2, 'ES2011b': 1}
+    """
+    spkrs = {}
+    for line in spkr_info:
+        fields = line.split()
+        spkrs.setdefault(fields[1], set()).add(fields[7])
+
+    return {rec_id: len(rec_spkrs) for rec_id, rec_spkrs in spkrs.items()}
+
+
 def spectral_embedding_sb(
     adjacency,
     n_components=8,
     norm_laplacian=True,
     drop_first=True,
+    device=None,
 ):
     """Returns spectral embeddings.
 
@@ -545,6 +808,10 @@ def spectral_embedding_sb(
         If True, then compute normalized Laplacian.
     drop_first : bool
         Whether to drop the first eigenvector.
+    device : str
+        If a GPU device is given (e.g., "cuda:0") and norm_laplacian is True,
+        the eigendecomposition runs there with torch. Otherwise (default),
+        scipy's `eigsh` is used on CPU.
 
     Returns
     -------
@@ -595,14 +862,25 @@ def spectral_embedding_sb(
 
     laplacian = _set_diag(laplacian, 1, norm_laplacian)
 
-    laplacian *= -1
-
-    vals, diffusion_map = eigsh(
-        laplacian,
-        k=n_components,
-        sigma=1.0,
-        which="LM",
-    )
+    if (
+        norm_laplacian
+        and device is not None
+        and torch.device(device).type != "cpu"
+    ):
+        diffusion_map = _smallest_eigvecs_torch(laplacian, n_components, device)
+    else:
+        laplacian *= -1
+
+        # Fixed starting vector: ARPACK's own one depends on the previous
+        # calls in the process.
+        v0 = np.random.RandomState(1234).uniform(-1, 1, laplacian.shape[0])
+        vals, diffusion_map = eigsh(
+            laplacian,
+            k=n_components,
+            sigma=1.0,
+            which="LM",
+            v0=v0,
+        )
 
     embedding = diffusion_map.T[n_components::-1]
 
@@ -622,6 +900,8 @@ def spectral_clustering_sb(
     n_components=None,
     random_state=None,
     n_init=10,
+    device=None,
+    max_samples=None,
 ):
     """Performs spectral clustering.
 
@@ -637,6 +917,12 @@ def spectral_clustering_sb(
         A pseudo random number generator used by kmeans.
     n_init : int
         Number of time the k-means algorithm will be run with different centroid seeds.
+    device : str
+        Device used for the eigendecomposition (see `spectral_embedding_sb`).
+    max_samples : int
+        If given and the affinity matrix has more rows, the spectral embedding
+        is computed on `max_samples` samples only
+        (see `spectral_embedding_subsampled`). Default: None (no subsampling).
 
     Returns
     -------
@@ -659,14 +945,26 @@ def spectral_clustering_sb(
     ... [0.5, 0, 0, 0, 0, 0, 1, 1, 1, 1]])
     >>> labs = diar.spectral_clustering_sb(affinity, 3)
     >>> # print (labs) # [2 2 2 1 1 1 0 0 0 0]
+    >>> # Clusters with 30 out of 120 samples in the eigendecomposition
+    >>> from sklearn.metrics import adjusted_rand_score
+    >>> rng = np.random.RandomState(0)
+    >>> emb = np.concatenate([rng.randn(40, 8) + 2 * i for i in range(3)])
+    >>> affinity = diar.Spec_Cluster().get_affinity(emb, 10)
+    >>> labs = diar.spectral_clustering_sb(affinity, 3, random_state=0)
+    >>> sub_labs = diar.spectral_clustering_sb(
+    ...     affinity, 3, random_state=0, max_samples=30
+    ... )
+    >>> adjusted_rand_score(labs, sub_labs)
+    1.0
     """
     random_state = _check_random_state(random_state)
     n_components = n_clusters if n_components is None else n_components
 
-    maps = spectral_embedding_sb(
+    maps = spectral_embedding_subsampled(
         affinity,
         n_components=n_components,
-        drop_first=False,
+        device=device,
+        max_samples=max_samples,
     )
 
     _, labels, _ = k_means(
@@ -676,10 +974,137 @@ def spectral_clustering_sb(
     return labels
 
 
+def spectral_embedding_subsampled(
+    affinity, n_components=8, device=None, max_samples=None
+):
+    """Returns the spectral embeddings (without dropping the first
+    eigenvector) of all the samples, with the eigendecomposition computed on
+    a uniform subsample of them when there are more than `max_samples`.
+    Each remaining sample is embedded as the affinity-weighted average of
+    the embeddings of the selected samples.
+
+    Arguments
+    ---------
+    affinity : matrix
+        Affinity matrix.
+    n_components : int
+        The dimension of the projection subspace.
+    device : str
+        Device used for the eigendecomposition (see `spectral_embedding_sb`).
+    max_samples : int
+        Number of samples used for the eigendecomposition.
+        Default: None (all, same as `spectral_embedding_sb`).
+
+    Returns
+    -------
+    embedding : array (n_samples, n_components)
+        Spectral embeddings for each sample.
+    """
+    n_samples = affinity.shape[0]
+    if max_samples is None or n_samples <= max_samples:
+        return spectral_embedding_sb(
+            affinity,
+            n_components=n_components,
+            drop_first=False,
+            device=device,
+        )
+
+    affinity = sparse.csr_matrix(affinity)
+
+    # Uniformly spaced samples (sub-segments are ordered in time)
+    sub_idx = np.linspace(0, n_samples - 1, max_samples).astype(int)
+
+    # Samples are connected to the selected ones through their common
+    # neighbors in the full graph (a plain sub-matrix would lose most of the
+    # edges of sparse graphs such as the kNN one).
+    weights = affinity @ affinity[:, sub_idx]
+
+    maps = spectral_embedding_sb(
+        weights[sub_idx],
+        n_components=n_components,
+        drop_first=False,
+        device=device,
+    )
+
+    # Extend the embeddings to all the samples as the weighted average of
+    # the embeddings of the selected samples.
+    degree = np.asarray(weights.sum(axis=1)).ravel()
+    degree[degree == 0] = 1.0
+    return sparse.diags(1.0 / degree) @ weights @ maps
+
+
+def kneighbors_graph_sb(X, n_neighbors=10, device=None):
+    """Returns the k-nearest-neighbors connectivity graph of the embeddings.
+    Each sample is counted as its own neighbor (as `include_self=True` in
+    sklearn). When FAISS is installed, an exact (L2) search is performed with
+    it. Otherwise, sklearn's `kneighbors_graph` is used.
+
+    Arguments
+    ---------
+    X : array (n_samples, n_features)
+        Embeddings.
+    n_neighbors : int
+        Number of neighbors of each sample.
+    device : str
+        If a CUDA device is given (e.g., "cuda:1") and FAISS has GPU support,
+        the search runs on that GPU. Otherwise (default), it runs on CPU.
+
+    Returns
+    -------
+    connectivity : sparse matrix (n_samples, n_samples)
+        Row i has ones at the columns of the n_neighbors nearest samples of i.
+
+    Example
+    -------
+    >>> import numpy as np
+    >>> from speechbrain.processing import diarization as diar
+    >>> X = np.array([[0.0, 0.0], [0.1, 0.0], [5.0, 5.0], [5.0, 5.2]])
+    >>> diar.kneighbors_graph_sb(X, 2).toarray()
+    array([[1., 1., 0., 0.],
+           [1., 1., 0., 0.],
+           [0., 0., 1., 1.],
+           [0., 0., 1., 1.]])
+    """
+    if not FAISS_AVAILABLE:
+        return kneighbors_graph(X, n_neighbors=n_neighbors, include_self=True)
+
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    n_samples, n_features = X.shape
+    if n_neighbors > n_samples:
+        raise ValueError(
+            "Expected n_neighbors <= n_samples, but n_neighbors = %d, "
+            "n_samples = %d" % (n_neighbors, n_samples)
+        )
+
+    index = faiss.IndexFlatL2(n_features)
+    if (
+        device is not None
+        and torch.device(device).type == "cuda"
+        and hasattr(faiss, "StandardGpuResources")
+        and faiss.get_num_gpus() > 0
+    ):
+        # The GPU resources (temporary memory, streams) are reused by the
+        # following calls.
+        global _faiss_gpu_resources
+        if _faiss_gpu_resources is None:
+            _faiss_gpu_resources = faiss.StandardGpuResources()
+        gpu_id = torch.device(device).index or 0
+        index = faiss.index_cpu_to_gpu(_faiss_gpu_resources, gpu_id, index)
+    index.add(X)
+    _, neighbors = index.search(X, n_neighbors)
+
+    rows = np.repeat(np.arange(n_samples), n_neighbors)
+    connectivity = sparse.csr_matrix(
+        (np.ones(rows.shape[0]), (rows, neighbors.ravel())),
+        shape=(n_samples, n_samples),
+    )
+    return connectivity
+
+
 class Spec_Cluster(SpectralClustering):
     """Performs spectral clustering using sklearn on embeddings."""
 
-    def perform_sc(self, X, n_neighbors=10):
+    def perform_sc(self, X, n_neighbors=10, device=None, max_samples=None):
         """
         Performs spectral clustering using sklearn on embeddings.
 
@@ -689,6 +1114,12 @@ class Spec_Cluster(SpectralClustering):
             Embeddings to be clustered.
         n_neighbors : int
             Number of neighbors in estimating affinity matrix.
+        device : str
+            Device used for the kNN search (see `kneighbors_graph_sb`) and the
+            eigendecomposition (see `spectral_embedding_sb`).
+        max_samples : int
+            Maximum number of samples used for the eigendecomposition
+            (see `spectral_clustering_sb`). Default: None (all).
 
         Returns
         -------
@@ -699,20 +1130,45 @@ class Spec_Cluster(SpectralClustering):
         https://github.com/scikit-learn/scikit-learn/blob/0fb307bf3/sklearn/cluster/_spectral.py
         """
         # Computation of affinity matrix
-        connectivity = kneighbors_graph(
-            X,
-            n_neighbors=n_neighbors,
-            include_self=True,
-        )
-        self.affinity_matrix_ = 0.5 * (connectivity + connectivity.T)
+        self.get_affinity(X, n_neighbors, device=device)
 
         # Perform spectral clustering on affinity matrix
         self.labels_ = spectral_clustering_sb(
             self.affinity_matrix_,
             n_clusters=self.n_clusters,
+            random_state=self.random_state,
+            device=device,
+            max_samples=max_samples,
         )
         return self
 
+    def get_affinity(self, X, n_neighbors=10, device=None):
+        """
+        Computes the (binary) nearest neighbors affinity matrix of the embeddings.
+
+        Arguments
+        ---------
+        X : array (n_samples, n_features)
+            Embeddings to be clustered.
+        n_neighbors : int
+            Number of neighbors in estimating affinity matrix.
+        device : str
+            Device used for the kNN search (see `kneighbors_graph_sb`).
+
+        Returns
+        -------
+        affinity_matrix : sparse matrix (n_samples, n_samples)
+            Also stored in `self.affinity_matrix_`.
+        """
+        connectivity = kneighbors_graph_sb(
+            X, n_neighbors=n_neighbors, device=device
+        )
+
+        # Binary symmetrization: i and j are connected if either of them is a
+        # neighbor of the other (the sparse element-wise max keeps 0/1 values).
+        self.affinity_matrix_ = connectivity.maximum(connectivity.T).tocsr()
+        return self.affinity_matrix_
+
 
 #####################
 
@@ -728,6 +1184,8 @@ class Spec_Clust_unorm:
         Minimum number of expected speakers.
     max_num_spkrs : int
         Maximum number of expected speakers.
+    random_state : int
+        Seed of kmeans. Default: None (numpy's global random state).
 
     Reference
     ---------
@@ -792,10 +1250,11 @@ class Spec_Clust_unorm:
     >>> # print(clust.labels_) # [0 0 0 2 2 2 1 1 1 1]
     """
 
-    def __init__(self, min_num_spkrs=2, max_num_spkrs=10):
+    def __init__(self, min_num_spkrs=2, max_num_spkrs=10, random_state=None):
 
         self.min_num_spkrs = min_num_spkrs
         self.max_num_spkrs = max_num_spkrs
+        self.random_state = random_state
 
     def do_spec_clust(self, X, k_oracle, p_val):
         """Function for spectral clustering.
@@ -952,7 +1411,7 @@ class Spec_Clust_unorm:
         k : int
             Number of clusters to kmeans.
         """
-        _, self.labels_, _ = k_means(emb, k)
+        _, self.labels_, _ = k_means(emb, k, random_state=self.random_state)
 
     def getEigenGaps(self, eig_vals):
         """Returns the difference (gaps) between the Eigen values.
@@ -980,7 +1439,18 @@ class Spec_Clust_unorm:
 
 
 def do_spec_clustering(
-    diary_obj, out_rttm_file, rec_id, k, pval, affinity_type, n_neighbors
+    diary_obj,
+    out_rttm_file,
+    rec_id,
+    k,
+    pval,
+    affinity_type,
+    n_neighbors,
+    device=None,
+    spec_cache=None,
+    n_components=None,
+    max_samples=None,
+    random_state=1234,
 ):
     """Performs spectral clustering on embeddings. This function calls specific
     clustering algorithms as per affinity.
@@ -1001,56 +1471,107 @@ def do_spec_clustering(
         Type of similarity to be used to get affinity matrix (cos or nn).
     n_neighbors : int
         Number of neighbors to use for clustering
+    device : str
+        Device used for the kNN search and the eigendecomposition of the nn
+        affinity (see `kneighbors_graph_sb` and `spectral_embedding_sb`).
+        Default: None (CPU).
+    spec_cache : dict
+        Only used with nn affinity, whose spectral embeddings do not depend on
+        k. If given, they are computed with `n_components` components and
+        stored in it, with the kmeans labels obtained so far, as
+        `spec_cache[rec_id] = (settings, embeddings, labels)`. Later calls
+        reuse them, so that only the missing kmeans fits are run for a
+        different k (see `_incremental_kmeans`). The labels for a given k do
+        not depend on what is already cached. `settings` holds the other
+        arguments the entry depends on (n_neighbors, n_components,
+        max_samples, device and random_state): the entry is recomputed when
+        they differ. Default: None (spectral clustering with k components
+        and 10 kmeans restarts, see `Spec_Cluster.perform_sc`).
+    n_components : int
+        Number of spectral components computed when filling `spec_cache`.
+        The first k components are used by kmeans. Use the same value across
+        calls so that the labels do not depend on the cache.
+        Default: None (k).
+    max_samples : int
+        Maximum number of sub-segments used for the eigendecomposition of the
+        nn affinity (see `spectral_embedding_subsampled`). Default: None (all).
+    random_state : int
+        Seed of kmeans. Pass a fixed value per recording (rather than relying
+        on numpy's global random state) so that the results do not depend on
+        the other recordings clustered in the same process.
+
+    Returns
+    -------
+    lines : list of str
+        The lines of the output RTTM file.
     """
     if affinity_type == "cos":
-        clust_obj = Spec_Clust_unorm(min_num_spkrs=2, max_num_spkrs=10)
+        clust_obj = Spec_Clust_unorm(
+            min_num_spkrs=2, max_num_spkrs=10, random_state=random_state
+        )
         k_oracle = k  # use it only when oracle num of speakers
         clust_obj.do_spec_clust(diary_obj.stat1, k_oracle, pval)
         labels = clust_obj.labels_
-    else:
+    elif spec_cache is None:
         clust_obj = Spec_Cluster(
             n_clusters=k,
             assign_labels="kmeans",
-            random_state=1234,
+            random_state=random_state,
             affinity="nearest_neighbors",
         )
-        clust_obj.perform_sc(diary_obj.stat1, n_neighbors)
+        clust_obj.perform_sc(
+            diary_obj.stat1,
+            n_neighbors,
+            device=device,
+            max_samples=max_samples,
+        )
         labels = clust_obj.labels_
-
-    # Convert labels to speaker boundaries
-    subseg_ids = diary_obj.segset
-    lol = []
-
-    for i in range(labels.shape[0]):
-        spkr_id = rec_id + "_" + str(labels[i])
-
-        sub_seg = subseg_ids[i]
-
-        splitted = sub_seg.rsplit("_", 2)
-        rec_id = str(splitted[0])
-        sseg_start = float(splitted[1])
-        sseg_end = float(splitted[2])
-
-        a = [rec_id, sseg_start, sseg_end, spkr_id]
-        lol.append(a)
-
-    # Sorting based on start time of sub-segment
-    lol.sort(key=lambda x: float(x[1]))
-
-    # Merge and split in 2 simple steps: (i) Merge sseg of same speakers then (ii) split different speakers
-    # Step 1: Merge adjacent sub-segments that belong to same speaker (or cluster)
-    lol = merge_ssegs_same_speaker(lol)
-
-    # Step 2: Distribute duration of adjacent overlapping sub-segments belonging to different speakers (or cluster)
-    # Taking mid-point as the splitting time location.
-    lol = distribute_overlap(lol)
+    else:
+        # nn affinity: the spectral embeddings do not depend on k.
+        # The cached entry is only reused if it was computed with the same
+        # settings (and enough components).
+        settings = (
+            n_neighbors,
+            n_components,
+            max_samples,
+            device,
+            random_state,
+        )
+        entry = spec_cache.get(rec_id)
+        if entry is None or entry[0] != settings or entry[1].shape[1] < k:
+            clust_obj = Spec_Cluster(
+                n_clusters=k,
+                assign_labels="kmeans",
+                random_state=random_state,
+                affinity="nearest_neighbors",
+            )
+            affinity_matrix = clust_obj.get_affinity(
+                diary_obj.stat1, n_neighbors, device=device
+            )
+            maps = spectral_embedding_subsampled(
+                affinity_matrix,
+                n_components=max(k, n_components or k),
+                device=device,
+                max_samples=max_samples,
+            )
+            spec_cache[rec_id] = (settings, maps, [])
+
+        _, maps, all_labels = spec_cache[rec_id]
+        all_labels = _incremental_kmeans(maps, k, all_labels, random_state)
+        spec_cache[rec_id] = (settings, maps, all_labels)
+        labels = all_labels[k - 1]
+
+    # Convert labels to speaker boundaries, sorted by start time.
+    # Adjacent sub-segments of the same speaker are merged, then the overlaps
+    # between different speakers are split at their mid-point.
+    lol = labels_to_segments(diary_obj.segset, labels, rec_id, postprocess=True)
 
     # logger.info("Completed diarizing " + rec_id)
-    write_rttm(lol, out_rttm_file)
+    return write_rttm(lol, out_rttm_file)
 
 
 def do_kmeans_clustering(
-    diary_obj, out_rttm_file, rec_id, k_oracle=4, p_val=0.3
+    diary_obj, out_rttm_file, rec_id, k_oracle=4, p_val=0.3, random_state=1234
 ):
     """Performs kmeans clustering on embeddings.
 
@@ -1068,6 +1589,13 @@ def do_kmeans_clustering(
         `pval` for pruning affinity matrix. Used only when number of speakers
         are unknown. Note that this is just for experiment. Prefer Spectral clustering
         for better clustering results.
+    random_state : int
+        Seed of kmeans (see `do_spec_clustering`).
+
+    Returns
+    -------
+    lines : list of str
+        The lines of the output RTTM file.
     """
     if k_oracle is not None:
         num_of_spk = k_oracle
@@ -1095,38 +1623,17 @@ def do_kmeans_clustering(
         _, num_of_spk = clust_obj.get_spec_embs(laplacian, k_oracle)
 
     # Perform kmeans directly on deep embeddings
-    _, labels, _ = k_means(diary_obj.stat1, num_of_spk)
-
-    # Convert labels to speaker boundaries
-    subseg_ids = diary_obj.segset
-    lol = []
-
-    for i in range(labels.shape[0]):
-        spkr_id = rec_id + "_" + str(labels[i])
-
-        sub_seg = subseg_ids[i]
-
-        splitted = sub_seg.rsplit("_", 2)
-        rec_id = str(splitted[0])
-        sseg_start = float(splitted[1])
-        sseg_end = float(splitted[2])
-
-        a = [rec_id, sseg_start, sseg_end, spkr_id]
-        lol.append(a)
-
-    # Sorting based on start time of sub-segment
-    lol.sort(key=lambda x: float(x[1]))
-
-    # Merge and split in 2 simple steps: (i) Merge sseg of same speakers then (ii) split different speakers
-    # Step 1: Merge adjacent sub-segments that belong to same speaker (or cluster)
-    lol = merge_ssegs_same_speaker(lol)
+    _, labels, _ = k_means(
+        diary_obj.stat1, num_of_spk, random_state=random_state
+    )
 
-    # Step 2: Distribute duration of adjacent overlapping sub-segments belonging to different speakers (or cluster)
-    # Taking mid-point as the splitting time location.
-    lol = distribute_overlap(lol)
+    # Convert labels to speaker boundaries, sorted by start time.
+    # Adjacent sub-segments of the same speaker are merged, then the overlaps
+    # between different speakers are split at their mid-point.
+    lol = labels_to_segments(diary_obj.segset, labels, rec_id, postprocess=True)
 
     # logger.info("Completed diarizing " + rec_id)
-    write_rttm(lol, out_rttm_file)
+    return write_rttm(lol, out_rttm_file)
 
 
 def do_AHC(diary_obj, out_rttm_file, rec_id, k_oracle=4, p_val=0.3):
@@ -1146,6 +1653,11 @@ def do_AHC(diary_obj, out_rttm_file, rec_id, k_oracle=4, p_val=0.3):
         `pval` for pruning affinity matrix. Used only when number of speakers
         are unknown. Note that this is just for experiment. Prefer Spectral clustering
         for better clustering results.
+
+    Returns
+    -------
+    lines : list of str
+        The lines of the output RTTM file.
     """
     from sklearn.cluster import AgglomerativeClustering
 
@@ -1175,33 +1687,10 @@ def do_AHC(diary_obj, out_rttm_file, rec_id, k_oracle=4, p_val=0.3):
         ).fit(diary_obj.stat1)
         labels = clustering.labels_
 
-    # Convert labels to speaker boundaries
-    subseg_ids = diary_obj.segset
-    lol = []
-
-    for i in range(labels.shape[0]):
-        spkr_id = rec_id + "_" + str(labels[i])
-
-        sub_seg = subseg_ids[i]
-
-        splitted = sub_seg.rsplit("_", 2)
-        rec_id = str(splitted[0])
-        sseg_start = float(splitted[1])
-        sseg_end = float(splitted[2])
-
-        a = [rec_id, sseg_start, sseg_end, spkr_id]
-        lol.append(a)
-
-    # Sorting based on start time of sub-segment
-    lol.sort(key=lambda x: float(x[1]))
-
-    # Merge and split in 2 simple steps: (i) Merge sseg of same speakers then (ii) split different speakers
-    # Step 1: Merge adjacent sub-segments that belong to same speaker (or cluster)
-    lol = merge_ssegs_same_speaker(lol)
-
-    # Step 2: Distribute duration of adjacent overlapping sub-segments belonging to different speakers (or cluster)
-    # Taking mid-point as the splitting time location.
-    lol = distribute_overlap(lol)
+    # Convert labels to speaker boundaries, sorted by start time.
+    # Adjacent sub-segments of the same speaker are merged, then the overlaps
+    # between different speakers are split at their mid-point.
+    lol = labels_to_segments(diary_obj.segset, labels, rec_id, postprocess=True)
 
     # logger.info("Completed diarizing " + rec_id)
-    write_rttm(lol, out_rttm_file)
+    return write_rttm(lol, out_rttm_file)
@@ -112,6 +112,15 @@ def test_input_normalization(device):
     target = torch.FloatTensor([-1, 0, 1, -2, -2, -2]).to(device)
     assert torch.equal(out_norm, target)
 
+    # Global mean normalization of embeddings (one frame each), as in the
+    # diarization recipes: every dimension is centred.
+    norm = InputNormalization(norm_type="global", std_norm=False).to(device)
+    emb = torch.randn([50, 1, 8], device=device) + 3.0
+    out_norm = norm(emb, torch.ones([50], device=device)).squeeze(1)
+    assert torch.allclose(
+        out_norm.mean(dim=0), torch.zeros(8, device=device), atol=1e-5
+    )
+
 
 def test_features_multimic(device):
     from speechbrain.processing.features import Filterbank